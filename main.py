@@ -1,38 +1,122 @@
+import io
 import os
-from pathlib import Path
+import re
+import time
+import queue
+import asyncio
+import logging
+import logging.handlers
+import dataclasses
+from collections import OrderedDict
 import cycls
 
+log = logging.getLogger(__name__)
+
+
+def _setup_logging() -> None:
+    # Records go through a queue to a background thread, so a slow stdout never
+    # blocks the event loop. Called from _get_options(), which chat runs once
+    # (single flight); the guard covers a retry after a failed warm-up.
+    if log.handlers:
+        return
+
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logging.handlers.QueueListener(records, handler).start()
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.propagate = False
+
+    # CYCLS_DEBUG=1 (env or .env) logs every SDK message
+    if get_env("CYCLS_DEBUG") == "1":
+        log.setLevel(logging.DEBUG)
+
+
 # ---------------------------
 # Env helper
 # ---------------------------
+# .env next to this file (works even if cwd is different)
+_ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+
+# Parsed .env contents, loaded on first miss (None = not loaded yet)
+_ENV_CACHE: dict[str, str] | None = None
+
+# .env keys this module put into os.environ, so reset_env_cache can undo them
+_ENV_EXPORTED: dict[str, str] = {}
+
+# KEY=value / KEY="value" / KEY='value' lines; comments and blanks never match.
+# Quotes are only removed when they are a matching pair around the value, and
+# a trailing " # comment" (whitespace before the #) is dropped.
+_ENV_RE = re.compile(
+    r"""^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*"""
+    r"""(?:"([^"\r\n]*)"|'([^'\r\n]*)'|(.*?))(?:[ \t]+#[^\r\n]*)?[ \t\r]*$""",
+    re.M,
+)
+
+
+def _load_dotenv() -> dict[str, str]:
+    global _ENV_CACHE
+    if _ENV_CACHE is not None:
+        return _ENV_CACHE
+
+    env = {}
+    # Last resort: try current working directory. Opening directly instead of
+    # probing with isfile() first saves a stat per path.
+    for env_path in (_ENV_PATH, ".env"):
+        try:
+            # Binary read skips the TextIOWrapper; decode once below
+            with open(env_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            # Missing or unreadable .env: try the next location
+            continue
+        text = data.decode("utf-8", "ignore")
+        env = {k: dq or sq or bare for k, dq, sq, bare in _ENV_RE.findall(text)}
+        break
+
+    # Export everything in one go; real environment variables take precedence
+    for k, v in env.items():
+        if k not in os.environ:
+            os.environ[k] = v
+            _ENV_EXPORTED[k] = v
+
+    _ENV_CACHE = env
+    return env
+
+
+# Resolved value per key; values never change during a process lifetime.
+# A plain dict rather than functools.lru_cache: cycls cloudpickles chat, and an
+# lru_cache wrapper defined in __main__ is pickled by reference (unloadable).
+_ENV_VALUES: dict[str, str | None] = {}
+
+
 def get_env(key: str) -> str | None:
-    val = os.getenv(key)
-    if val:
-        return val
+    if key in _ENV_VALUES:
+        return _ENV_VALUES[key]
 
-    # Fallback: read .env directly (works even if cwd is different)
-    env_path = Path(__file__).with_name(".env")
-    if not env_path.exists():
-        # Last resort: try current working directory
-        env_path = Path(".env")
+    # An exported-but-empty variable is a deliberate value: don't fall back
+    val = os.environ.get(key)
+    if val is None:
+        # Once .env is loaded this is a plain dict lookup: no stat, no read
+        env = _ENV_CACHE if _ENV_CACHE is not None else _load_dotenv()
+        val = env.get(key)
 
-    try:
-        if env_path.exists():
-            for line in env_path.read_text(
-                encoding="utf-8", errors="ignore"
-            ).splitlines():
-                line = line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                k, v = line.split("=", 1)
-                if k.strip() == key:
-                    v = v.strip().strip('"').strip("'")
-                    os.environ[key] = v
-                    return v
-    except Exception:
-        pass
-
-    return None
+    _ENV_VALUES[key] = val
+    return val
+
+
+def reset_env_cache() -> None:
+    # Forget memoized keys and the parsed .env (tests, or after editing .env)
+    global _ENV_CACHE
+    _ENV_CACHE = None
+    _ENV_VALUES.clear()
+
+    # Drop our own exports too, or the stale values would win over the new .env.
+    # A variable changed since the export belongs to someone else: keep it.
+    for k, v in _ENV_EXPORTED.items():
+        if os.environ.get(k) == v:
+            del os.environ[k]
+    _ENV_EXPORTED.clear()
 
 
 # ---------------------------
@@ -265,101 +349,245 @@ IMPORTANT:
 - Each post MUST have a distinct angle - if they feel similar, rewrite.
 """.strip()
 
+# Tool set shared by the main agent and the research/writing subagents
+WEB_TOOLS = ["WebSearch", "WebFetch"]
+
+# Subagent definitions as plain module-level data; AgentDefinition objects are
+# built from these once, in _get_options()
+SUBAGENTS = {
+    "brief-analyzer": dict(
+        description="REQUIRED for step 1. Analyzes and structures marketing briefs. Always use this agent FIRST when given any marketing brief or campaign request. Do not use general-purpose for brief analysis.",
+        prompt=BRIEF_ANALYZER_PROMPT,
+        model="sonnet",
+        tools=[],
+    ),
+    "market-researcher": dict(
+        description="REQUIRED for step 2. Performs market research including competitor analysis, audience insights, and trend analysis. Use this after brief-analyzer. Do not use general-purpose for market research.",
+        prompt=MARKET_RESEARCHER_PROMPT,
+        model="sonnet",
+        tools=WEB_TOOLS,
+    ),
+    "creative-director": dict(
+        description="REQUIRED for step 3. Creates 3-4 differentiated creative directions AND campaign routes from research. Use this after market-researcher. Do not use general-purpose for creative direction.",
+        prompt=CREATIVE_DIRECTOR_PROMPT,
+        model="sonnet",
+        tools=[],
+    ),
+    "social-media-writer": dict(
+        description="REQUIRED for step 4. Generates 4 ready-to-paste social media posts tied to approved campaign routes. Use this after creative-director and user route selection. Do not use general-purpose for content writing.",
+        prompt=SOCIAL_MEDIA_WRITER_PROMPT,
+        model="sonnet",
+        tools=WEB_TOOLS,
+    ),
+}
+
 # ---------------------------
-# Agent endpoint
+# Claude Agent SDK (imported once per process)
 # ---------------------------
-@agent("creative-marketing-strategist", title="Creative Marketing Agent", auth=True)
-async def chat(context):
-    from claude_agent_sdk import ClaudeSDKClient, ClaudeAgentOptions, AgentDefinition, AssistantMessage, TextBlock
+_SDK = None
+
+
+def _get_sdk():
+    # claude_agent_sdk is only installed in the deployed image (see pip=[...]),
+    # so it is imported on the first request instead of at module load.
+    global _SDK
+    if _SDK is None:
+        import claude_agent_sdk as _SDK
+    return _SDK
+
+
+# ---------------------------
+# Agent options (built once per process)
+# ---------------------------
+_OPTIONS = None
+
+
+def _get_options():
+    # Nothing here depends on the request: build on first use, reuse afterwards
+    global _OPTIONS
+    if _OPTIONS is not None:
+        return _OPTIONS
+
+    _setup_logging()
+
+    sdk = _get_sdk()
+    ClaudeAgentOptions, AgentDefinition = sdk.ClaudeAgentOptions, sdk.AgentDefinition
 
     # Ensure ANTHROPIC_API_KEY is in env (Claude Agent SDK reads env)
     api_key = get_env("ANTHROPIC_API_KEY")
-    if api_key:
+    if api_key and os.environ.get("ANTHROPIC_API_KEY") != api_key:
         os.environ["ANTHROPIC_API_KEY"] = api_key
 
-    # Latest user message
-    user_message = context.messages[-1]["content"] if context.messages else ""
-
     # Configure main agent with subagents
     # NOTE: Using sonnet for main agent to ensure reliable routing to custom subagents
-    options = ClaudeAgentOptions(
+    _OPTIONS = ClaudeAgentOptions(
         model="sonnet",
         system_prompt=MAIN_AGENT_PROMPT,
-        allowed_tools=["Task", "WebSearch", "WebFetch"],
-        continue_conversation=True,
+        allowed_tools=["Task", *WEB_TOOLS],
         # max_budget_usd=0.50,  # Cost ceiling to prevent runaway token usage
         # max_turns=15,  # Limit conversation turns
-        agents={
-            "brief-analyzer": AgentDefinition(
-                description="REQUIRED for step 1. Analyzes and structures marketing briefs. Always use this agent FIRST when given any marketing brief or campaign request. Do not use general-purpose for brief analysis.",
-                prompt=BRIEF_ANALYZER_PROMPT,
-                model="sonnet",
-                tools=[],
-            ),
-            "market-researcher": AgentDefinition(
-                description="REQUIRED for step 2. Performs market research including competitor analysis, audience insights, and trend analysis. Use this after brief-analyzer. Do not use general-purpose for market research.",
-                prompt=MARKET_RESEARCHER_PROMPT,
-                model="sonnet",
-                tools=["WebSearch", "WebFetch"],
-            ),
-            "creative-director": AgentDefinition(
-                description="REQUIRED for step 3. Creates 3-4 differentiated creative directions AND campaign routes from research. Use this after market-researcher. Do not use general-purpose for creative direction.",
-                prompt=CREATIVE_DIRECTOR_PROMPT,
-                model="sonnet",
-                tools=[],
-            ),
-            "social-media-writer": AgentDefinition(
-                description="REQUIRED for step 4. Generates 4 ready-to-paste social media posts tied to approved campaign routes. Use this after creative-director and user route selection. Do not use general-purpose for content writing.",
-                prompt=SOCIAL_MEDIA_WRITER_PROMPT,
-                model="sonnet",
-                tools=["WebSearch", "WebFetch"],
-            ),
-        },
+        agents={name: AgentDefinition(**spec) for name, spec in SUBAGENTS.items()},
     )
+    return _OPTIONS
+
+
+def _make_options(resume: str | None = None):
+    # Only the session to resume varies per request; everything else is shared
+    options = _get_options()
+    return dataclasses.replace(options, resume=resume) if resume else options
+
+
+# ---------------------------
+# Claude sessions
+# ---------------------------
+# conversation key -> (Claude session id, expiry), so each turn resumes its own
+# session. In-process LRU; oldest conversations are dropped past MAX_SESSIONS
+# and idle ones after SESSION_TTL seconds.
+MAX_SESSIONS = 10_000
+SESSION_TTL = 24 * 60 * 60
+CLAUDE_SESSIONS: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+
+def conversation_key_from_context(context) -> str | None:
+    # EAFP: the happy path is a couple of subscripts, not a chain of probes
+    try:
+        conversation_id = context.messages[-1]["metadata"]["conversation_id"]
+    except (AttributeError, IndexError, KeyError, TypeError):
+        conversation_id = None
+
+    # No per-user fallback: all of a user's chats would share one key and resume
+    # each other's sessions. Without an id, chat rebuilds from context.messages.
+    return f"conv:{conversation_id}" if conversation_id else None
+
+
+def build_history_prompt(messages: list[dict]) -> str:
+    # Prior turns + latest message as one prompt, for when no session can be resumed
+    history = "\n\n".join([
+        f"{msg.get('role', 'user').upper()}: {msg['content']}"
+        for msg in messages[:-1] if msg.get("content")
+    ])
+    latest = messages[-1].get("content", "")
+    return f"=== CONVERSATION SO FAR ===\n{history}\n\n=== LATEST MESSAGE ===\n{latest}"
+
+
+def get_session(convo_key: str) -> str | None:
+    entry = CLAUDE_SESSIONS.get(convo_key)
+    if entry is None:
+        return None
+
+    session_id, expires_at = entry
+    if expires_at <= time.monotonic():
+        del CLAUDE_SESSIONS[convo_key]
+        return None
+
+    CLAUDE_SESSIONS.move_to_end(convo_key)
+    return session_id
+
+
+def remember_session(convo_key: str, session_id: str) -> None:
+    CLAUDE_SESSIONS[convo_key] = (session_id, time.monotonic() + SESSION_TTL)
+    CLAUDE_SESSIONS.move_to_end(convo_key)
+    while len(CLAUDE_SESSIONS) > MAX_SESSIONS:
+        CLAUDE_SESSIONS.popitem(last=False)
+
+
+# ---------------------------
+# Agent endpoint
+# ---------------------------
+# In-flight _get_options warm-up, shared by concurrent first requests
+_WARMUP: asyncio.Future | None = None
+
+
+@agent("creative-marketing-strategist", title="Creative Marketing Agent", auth=True)
+async def chat(context):
+    # First request imports the SDK and may read .env: keep that blocking work
+    # off the event loop. Later requests find everything cached.
+    global _WARMUP
+    if _OPTIONS is None:
+        # Single flight: the first request starts one warm-up (set before any
+        # await, so no lock) and concurrent first requests wait on the same one
+        if _WARMUP is None:
+            _WARMUP = asyncio.ensure_future(asyncio.to_thread(_get_options))
+        try:
+            # shield: a caller disconnecting must not cancel everyone's warm-up
+            await asyncio.shield(_WARMUP)
+        except Exception:
+            # Let the next request try again instead of re-raising forever
+            _WARMUP = None
+            raise
+
+    sdk = _get_sdk()
+    ClaudeSDKClient, AssistantMessage, SystemMessage = sdk.ClaudeSDKClient, sdk.AssistantMessage, sdk.SystemMessage
+    TextBlock, ToolUseBlock = sdk.TextBlock, sdk.ToolUseBlock
+
+    # Latest user message (empty history or a content-less message is rare)
+    try:
+        user_message = context.messages[-1]["content"]
+    except (IndexError, KeyError):
+        user_message = ""
+
+    # A single message is a new chat: nothing to resume and no history to send
+    has_history = len(context.messages) > 1
+
+    # Resume this conversation's Claude session
+    convo_key = conversation_key_from_context(context)
+    resume_id = get_session(convo_key) if convo_key and has_history else None
+
+    options = _make_options(resume_id)
+    if not resume_id and has_history:
+        # No session (restart, eviction, no conversation id): send the history in one query
+        user_message = build_history_prompt(context.messages)
 
     # Buffer for main agent text (to handle text that precedes Task delegation)
-    main_agent_buffer = []
+    main_agent_buffer = io.StringIO()
+
+    def take_buffered() -> str:
+        buffered = main_agent_buffer.getvalue().strip()
+        main_agent_buffer.seek(0)
+        main_agent_buffer.truncate()
+        return buffered
+
+    # Checked once per request; per-message logging is skipped entirely otherwise
+    debug = log.isEnabledFor(logging.DEBUG)
 
     # Stream responses using ClaudeSDKClient for bidirectional streaming
     async with ClaudeSDKClient(options=options) as client:
         await client.query(user_message)
 
         async for message in client.receive_response():
-            msg_type = type(message).__name__
-
-            # DEBUG - log all message types and attributes
-            print(f"\n[DEBUG] msg_type={msg_type}")
-            print(f"[DEBUG] message attrs: {[a for a in dir(message) if not a.startswith('_')]}")
-
-            if isinstance(message, AssistantMessage):
-                parent_id = getattr(message, "parent_tool_use_id", None)
-                print(f"[DEBUG] parent_tool_use_id={parent_id}")
-                print(f"[DEBUG] buffer_len={len(main_agent_buffer)}")
-                print(f"[DEBUG] content blocks: {len(message.content)}")
-                for i, block in enumerate(message.content):
-                    block_type = type(block).__name__
-                    print(f"[DEBUG]   block[{i}]: {block_type}")
-                    if block_type == "ToolUseBlock":
-                        print(f"[DEBUG]     tool_name={getattr(block, 'name', None)}")
-                        tool_input = getattr(block, "input", {}) or {}
-                        if block.name == "Task":
-                            print(f"[DEBUG]     subagent_type={tool_input.get('subagent_type')}")
-            else:
-                # Log non-AssistantMessage details
-                print(f"[DEBUG] non-assistant message: {message}")
-
-            # Skip non-assistant messages
+            # DEBUG - one record per message: type, routing and content blocks
+            if debug:
+                if isinstance(message, AssistantMessage):
+                    blocks = ", ".join([
+                        f"ToolUseBlock({block.name}, subagent_type={(block.input or {}).get('subagent_type')})"
+                        if isinstance(block, ToolUseBlock) else type(block).__name__
+                        for block in message.content
+                    ])
+                    log.debug("AssistantMessage parent_tool_use_id=%s buffer_len=%d blocks=[%s]",
+                              message.parent_tool_use_id, main_agent_buffer.tell(), blocks)
+                else:
+                    log.debug("%s: %s", type(message).__name__, message)
+
+            # Non-assistant messages: only the init message matters, skip the rest
             if not isinstance(message, AssistantMessage):
+                # Remember the session id so the next turn can resume it
+                if isinstance(message, SystemMessage) and message.subtype == "init":
+                    session_id = (message.data or {}).get("session_id")
+                    if convo_key and session_id:
+                        remember_session(convo_key, session_id)
                 continue
 
-            parent_id = getattr(message, "parent_tool_use_id", None)
+            parent_id = message.parent_tool_use_id
             content = message.content or []
 
-            # Check if this is a Task delegation
+            # Single pass over the blocks: collect text and check for a Task delegation
+            texts = []
             task_info = None
             for block in content:
-                if type(block).__name__ == "ToolUseBlock" and block.name == "Task":
-                    tool_input = getattr(block, "input", {}) or {}
+                if isinstance(block, TextBlock):
+                    texts.append(block.text)
+                elif isinstance(block, ToolUseBlock) and block.name == "Task":
+                    tool_input = block.input or {}
                     subagent = tool_input.get("subagent_type", "unknown")
                     description = tool_input.get("description", "")
                     prompt = tool_input.get("prompt", "")
@@ -367,49 +595,45 @@ async def chat(context):
 
             # Main agent messages (parent_id is None)
             if parent_id is None:
+                # Collect main agent text into buffer (might precede a Task)
+                for text in texts:
+                    main_agent_buffer.write(text)
+
                 if task_info:
                     # Task delegation - format buffered text + delegation + prompt as code block
                     subagent, description, prompt = task_info
-                    buffered = "".join(main_agent_buffer).strip()
-                    main_agent_buffer.clear()
-
-                    # Build the delegation block
-                    parts = []
-                    if buffered:
-                        parts.append(f"💭 {buffered}")
-                    parts.append(f"🔄 Delegating to: {subagent} - {description}")
-                    if prompt:
-                        parts.append(f"\n📝 Prompt to subagent:\n{prompt}")
+                    buffered = take_buffered()
 
-                    yield f"\n```\n{chr(10).join(parts)}\n```\n"
-                    continue
-
-                # Collect main agent text into buffer (might precede a Task)
-                for block in content:
-                    if isinstance(block, TextBlock):
-                        main_agent_buffer.append(block.text)
+                    # Build the delegation block: optional thought, delegation line, optional prompt
+                    thought = f"💭 {buffered}\n" if buffered else ""
+                    prompt_part = f"\n\n📝 Prompt to subagent:\n{prompt}" if prompt else ""
+                    yield f"\n```\n{thought}🔄 Delegating to: {subagent} - {description}{prompt_part}\n```\n"
                 continue
 
             # Messages from subagents (parent_id is set)
             # Flush any buffered main agent text (without code block - it's just context)
-            if main_agent_buffer:
-                buffered = "".join(main_agent_buffer).strip()
-                main_agent_buffer.clear()
+            if main_agent_buffer.tell():
+                buffered = take_buffered()
                 if buffered:
                     yield f"\n{buffered}\n\n"
 
-            # Stream subagent output normally
-            for block in content:
-                if isinstance(block, TextBlock):
-                    yield block.text
+            # Stream subagent output, one chunk per message
+            text = "".join(texts)
+            if text:
+                yield text
 
     # Flush any remaining buffered text at the end (main agent's final response)
-    if main_agent_buffer:
-        buffered = "".join(main_agent_buffer).strip()
+    if main_agent_buffer.tell():
+        buffered = take_buffered()
         if buffered:
             yield buffered
 
 
+# The CYCLS_API_KEY lookup above filled the env caches on this (deploy) machine.
+# chat is pickled with them, so clear them: the container then parses its own
+# copied .env (/app/.env, found via the cwd fallback) and exports it there.
+reset_env_cache()
+
 agent.deploy(prod=False)
 # agent.local()
 # agent.deploy(prod=True)